@@ -5,7 +5,13 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from threading import Lock, Event
 from pathlib import Path
-import json, time, threading
+import asyncio, json, time, threading
+
+try:
+    import orjson                      # 2-5x faster dumps, if available
+    def _dumps(obj): return orjson.dumps(obj)
+except ImportError:
+    def _dumps(obj): return json.dumps(obj).encode()
 
 from PCA9685 import PCA9685
 
@@ -13,6 +19,31 @@ from PCA9685 import PCA9685
 pwm = PCA9685(0x40, debug=False)
 pwm.setPWMFreq(50)
 
+# PCA9685 registers (the Waveshare driver keeps these private)
+_MODE1 = 0x00
+_LED0_ON_L = 0x06
+_AUTO_INCREMENT = 0x20
+
+# enable register auto-increment so a whole motor's channels can go out
+# in one I2C block write; fall back to per-channel calls if the driver
+# doesn't expose its smbus handle
+try:
+    _bus, _addr = pwm.bus, pwm.address
+    pwm.write(_MODE1, pwm.read(_MODE1) | _AUTO_INCREMENT)
+except AttributeError:
+    _bus = _addr = None
+
+
+def _write_channel_block(base_channel: int, on_off):
+    """Write (on, off) pairs for consecutive channels in one I2C transfer.
+
+    on_off: 12-bit (on, off) pairs, one per channel starting at base_channel.
+    """
+    payload = []
+    for on, off in on_off:
+        payload += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+    _bus.write_i2c_block_data(_addr, _LED0_ON_L + 4 * base_channel, payload)
+
 
 def _set_dutycycle(channel: int, percent: int):
     """Set PWM duty cycle. percent: 0-100."""
@@ -33,45 +64,57 @@ class MotorDriver:
         self.PWMB = 5
         self.BIN1 = 3
         self.BIN2 = 4
+        # (pwm, in1, in2) per motor id so MotorRun is a lookup, not a branch
+        self._channels = ((self.PWMA, self.AIN1, self.AIN2),
+                          (self.PWMB, self.BIN1, self.BIN2))
         self._lock = Lock()          # protects all I2C / PWM calls
+        self._last = None            # last (left, right) actually written
 
     def MotorRun(self, motor: int, direction: str, speed: int):
+        pwm_ch, in1, in2 = self._channels[1 if motor else 0]
         speed = max(0, min(100, int(speed)))
-        if motor == 0:
-            _set_dutycycle(self.PWMA, speed)
-            if direction == "forward":
-                _set_level(self.AIN1, 0); _set_level(self.AIN2, 1)
-            else:
-                _set_level(self.AIN1, 1); _set_level(self.AIN2, 0)
+        forward = direction == "forward"
+        if _bus is not None:
+            # each motor's three channels are consecutive, so duty cycle and
+            # both direction pins go out as a single 12-byte block transfer
+            values = {pwm_ch: (0, int(speed * (4096 / 100))),
+                      in1: (0, 0 if forward else 4095),
+                      in2: (0, 4095 if forward else 0)}
+            base = min(values)
+            _write_channel_block(base, (values[base], values[base + 1],
+                                        values[base + 2]))
         else:
-            _set_dutycycle(self.PWMB, speed)
-            if direction == "forward":
-                _set_level(self.BIN1, 0); _set_level(self.BIN2, 1)
+            _set_dutycycle(pwm_ch, speed)
+            if forward:
+                _set_level(in1, 0); _set_level(in2, 1)
             else:
-                _set_level(self.BIN1, 1); _set_level(self.BIN2, 0)
+                _set_level(in1, 1); _set_level(in2, 0)
 
     def MotorStop(self, motor: int):
-        if motor == 0:
-            _set_dutycycle(self.PWMA, 0)
-        else:
-            _set_dutycycle(self.PWMB, 0)
+        _set_dutycycle(self._channels[1 if motor else 0][0], 0)
 
     def Tank(self, left: float, right: float):
         """Thread-safe tank drive. Values in -1.0 .. 1.0 range."""
         with self._lock:
+            last = self._last
+            if (last is not None and abs(left - last[0]) < 1e-3
+                    and abs(right - last[1]) < 1e-3):
+                return               # identical command, skip the I2C chatter
             self._tank_unlocked(left, right)
+            self._last = (left, right)
 
     def _tank_unlocked(self, left: float, right: float):
-        def side(motor, val):
-            if abs(val) < 1e-3:
-                self.MotorStop(motor)
-                return
-            sp = int(abs(val) * 100)
-            direction = 'forward' if val > 0 else 'backward'
-            self.MotorRun(motor, direction, sp)
-
-        side(0, left)
-        side(1, right)
+        # straight-line code, no per-call closure
+        if abs(left) < 1e-3:
+            self.MotorStop(0)
+        else:
+            self.MotorRun(0, 'forward' if left > 0 else 'backward',
+                          int(abs(left) * 100))
+        if abs(right) < 1e-3:
+            self.MotorStop(1)
+        else:
+            self.MotorRun(1, 'forward' if right > 0 else 'backward',
+                          int(abs(right) * 100))
 
 
 MOTOR = MotorDriver()
@@ -84,12 +127,8 @@ _drive_lock = Lock()         # serialises drive_for launches
 def drive_for(left: float, right: float, seconds: float):
     """Drive motors, then stop. Cancellable by setting _drive_cancel."""
     MOTOR.Tank(left, right)
-    # sleep in small steps so we can be cancelled quickly
-    end = time.monotonic() + seconds
-    while time.monotonic() < end:
-        if _drive_cancel.is_set():
-            break
-        time.sleep(0.05)
+    # returns immediately on cancel, or after the full duration otherwise
+    _drive_cancel.wait(timeout=seconds)
     MOTOR.Tank(0.0, 0.0)
 
 
@@ -119,7 +158,6 @@ app.add_middleware(
 )
 
 STATE_PATH = Path(__file__).with_name("robotState.json")
-stateLock = Lock()
 
 
 class ControlData(BaseModel):
@@ -132,56 +170,80 @@ class ControlData(BaseModel):
     duration: float = Field(0.8, ge=0.05, le=5.0)
 
 
-robotState = {
+# canonical state is published by pointer swap: writers build a fresh dict
+# and store it at _state_ref[0] (atomic under the GIL), readers just grab
+# the current reference -- no lock on either path. Both writers are async
+# handlers on the event loop, so updates never interleave anyway.
+_state_ref = [{
     "up": False, "down": False, "left": False, "right": False,
     "command": "stop", "command_id": 0, "timestamp": int(time.time()),
     "speed": 0.6, "duration": 0.8,
-}
+}]
+
+
+# --------------- debounced state writer ---------------
+# robotState is ephemeral control state, so no need for a tmp+rename
+# flush per request: handlers just flag it dirty and a background thread
+# coalesces bursts into one write ~100 ms later.
+_state_dirty = Event()
+
 
+def _state_writer():
+    while True:
+        _state_dirty.wait()
+        time.sleep(0.1)              # let a burst of updates coalesce
+        _state_dirty.clear()
+        try:
+            STATE_PATH.write_bytes(_dumps(_state_ref[0]))
+        except OSError as e:
+            # disk full / read-only fs: complain but keep the writer alive
+            print(f"robotState write failed: {e}")
 
-def write_state_to_disk(state: dict):
-    tmp = STATE_PATH.with_suffix(".json.tmp")
-    tmp.write_text(json.dumps(state))
-    tmp.replace(STATE_PATH)
+
+threading.Thread(target=_state_writer, daemon=True).start()
+
+
+# (left sign, right sign) per command; anything else means stop
+_CMD_SIGNS = {
+    "forward": (1, 1), "start": (1, 1), "move": (1, 1),
+    "back": (-1, -1), "backward": (-1, -1),
+    "left": (-1, 1), "right": (1, -1),
+}
 
 
 def cmd_to_tank(cmd: str, sp: float) -> tuple[float, float]:
-    c = (cmd or "").lower()
-    if c in ("forward", "start", "move"): return sp, sp
-    if c in ("back", "backward"):         return -sp, -sp
-    if c == "left":                        return -sp, sp
-    if c == "right":                       return sp, -sp
-    return 0.0, 0.0
+    dl, dr = _CMD_SIGNS.get((cmd or "").lower(), (0, 0))
+    return dl * sp, dr * sp
 
 
 @app.get("/")
-def root():
+async def root():
     return {"ok": True, "driver": "Waveshare PCA9685 + MotorDriver", "pwm_freq": 50}
 
 
 @app.get("/control/status")
-def status():
-    with stateLock:
-        return dict(robotState)          # return a snapshot copy
+async def status():
+    return _state_ref[0]                 # published snapshot, never mutated
 
 
 @app.post("/control/stop")
-def stop():
+async def stop():
     _drive_cancel.set()                  # cancel any timed drive
-    MOTOR.Tank(0.0, 0.0)
-    with stateLock:
-        robotState.update({"command": "stop"})
-        robotState["command_id"] += 1
-        robotState["timestamp"] = int(time.time())
-        snap = dict(robotState)
-        write_state_to_disk(robotState)
+    await asyncio.to_thread(MOTOR.Tank, 0.0, 0.0)   # keep I2C off the event loop
+    snap = dict(_state_ref[0])
+    snap |= {"command": "stop"}
+    snap["command_id"] += 1
+    snap["timestamp"] = int(time.time())
+    _state_ref[0] = snap
+    _state_dirty.set()
     return {"message": "stopped", "state": snap}
 
 
 @app.post("/control/set")
-def update_controls(data: ControlData):
-    sp = max(0.0, min(1.0, float(data.speed)))
-    dur = float(data.duration)
+async def update_controls(data: ControlData):
+    # pydantic already validated/coerced speed and duration ranges
+    sp = data.speed
+    dur = data.duration
 
     cmd = data.command
     if not cmd:
@@ -197,16 +259,16 @@ def update_controls(data: ControlData):
         launch_drive(L, R, dur)          # cancels previous, starts new thread
     else:
         _drive_cancel.set()              # cancel any running timed drive
-        MOTOR.Tank(L, R)
-
-    with stateLock:
-        robotState.update({
-            "up": data.up, "down": data.down, "left": data.left, "right": data.right,
-            "command": cmd, "speed": sp, "duration": dur
-        })
-        robotState["command_id"] += 1
-        robotState["timestamp"] = int(time.time())
-        snap = dict(robotState)
-        write_state_to_disk(robotState)
+        await asyncio.to_thread(MOTOR.Tank, L, R)
+
+    snap = dict(_state_ref[0])
+    snap |= {
+        "up": data.up, "down": data.down, "left": data.left, "right": data.right,
+        "command": cmd, "speed": sp, "duration": dur,
+    }
+    snap["command_id"] += 1
+    snap["timestamp"] = int(time.time())
+    _state_ref[0] = snap
+    _state_dirty.set()
 
     return {"message": "Updated & driving", "state": snap}